@@ -1,19 +1,40 @@
 #!/usr/bin/env python3
-import os, json, re, time, html
+import os, json, re, time, html, asyncio, shutil, subprocess
 from pathlib import Path
 from io import BytesIO
-from typing import Dict, Any, List, Tuple, Optional
+from typing import Dict, Any, List, Tuple, Optional, Callable
 from datetime import datetime, timezone
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache
+from bisect import bisect_right
+from itertools import accumulate
 
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
 from reportlab.lib.colors import Color, black, white, HexColor
 from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from pypdf import PdfReader, PdfWriter
+from pypdf.annotations import Link
+from pypdf.generic import NameObject, BooleanObject
 from PIL import Image
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
 
 PAGE_SIZE = letter
 MARGIN = 54
@@ -26,6 +47,9 @@ TITLE_FS = 22
 H2_FS = 14
 H3_FS = 11.5
 TOC_ROW = 16
+STATUS_KEY_FORM = "statusKey"
+DOT_W11 = stringWidth(".", FONT, 11)
+MAX_DOTS = "." * int((W - 2*MARGIN) / DOT_W11)
 CARD_PAD = 10
 GAP = 10
 COLOR_BG = HexColor("#0A0F1F")
@@ -36,72 +60,194 @@ COLOR_I = HexColor("#3BB273")
 COLOR_NI = HexColor("#F5A524")
 COLOR_NP = HexColor("#9AA5B1")
 COLOR_D = HexColor("#E25555")
+_STATUS_COLORS = {"D": COLOR_D, "NI": COLOR_NI, "NP": COLOR_NP}
 INLINE_IMG_MAX_H = 2.4 * inch
-JPEG_QUALITY = 75
 SKIP_LARGE_IMAGES = True
+MAX_IMAGE_BYTES = 5_000_000
+JPEG_QUALITY = 75
+WRITE_BUFFER = 1 << 20  # pypdf issues many small writes; batch them into 1 MiB chunks
 MEDIA_TOKEN_RE = re.compile(r"\[M#(\d+)\]")
 COVER_IMAGE_PATH = Path(__file__).parent / "pic1.jpg"
 MAX_MEDIA_THREADS = 12
+IMG_CACHE_SIZE = 256
 REQUEST_TIMEOUT = (3.0, 5.0)
 DEBUG_TIMING = os.environ.get("DEBUG_TIMING", "0") == "1"
+OPTIMIZE_PDF = os.environ.get("OPTIMIZE_PDF", "0") == "1"
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "1"))  # >1 renders sections in a process pool
+_footer_page_numbers = True
+
+# url -> decoded ImageReader, shared across renders in the same process (LRU)
+_IMG_CACHE: "OrderedDict[str, ImageReader]" = OrderedDict()
+
+_SESSION = requests.Session()
+_SESSION.headers["Accept-Encoding"] = "identity"
+_adapter = HTTPAdapter(pool_connections=MAX_MEDIA_THREADS, pool_maxsize=MAX_MEDIA_THREADS * 2, max_retries=0)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
 
 def ms_to_iso(ms):
     if isinstance(ms, int):
         return datetime.fromtimestamp(ms/1000.0, tz=timezone.utc).date().isoformat()
     return "Data not found in test data"
 
+def _compile_path(path: str) -> Callable[[Any], Any]:
+    keys = tuple(path.split("."))
+    def get(cur):
+        for k in keys:
+            if not isinstance(cur, dict):
+                return None
+            cur = cur.get(k)
+        return cur
+    return get
+
+ACC: Dict[str, Callable[[Any], Any]] = {p: _compile_path(p) for p in (
+    "clientInfo.name", "schedule.date", "inspector.name", "inspector.license",
+    "address.fullAddress", "address.street", "address.city", "address.state", "address.zipcode",
+)}
+
 def getv(doc: Dict[str, Any], path: str, default="Data not found in test data"):
-    cur = doc
-    for k in path.split("."):
-        if isinstance(cur, dict) and k in cur:
-            cur = cur[k]
-        else:
-            return default
+    acc = ACC.get(path)
+    if acc is None:
+        acc = ACC[path] = _compile_path(path)
+    cur = acc(doc)
     return cur if cur not in ("", None) else default
 
-def wrap_lines(text: str, c0: canvas.Canvas, max_width: float, fs: float) -> List[str]:
-    c0.setFont(FONT, fs)
+@lru_cache(maxsize=None)
+def _char_widths(font: str) -> Tuple[float, ...]:
+    return tuple(stringWidth(chr(i), font, 1000) for i in range(128))
+
+@lru_cache(maxsize=8192)
+def fast_width(text: str, font: str, fs: float) -> float:
+    if not text.isascii():
+        return stringWidth(text, font, fs)
+    cw = _char_widths(font)
+    return sum([cw[ord(ch)] for ch in text]) * fs / 1000
+
+def _wrap_para(para: str, max_width: float, fs: float) -> List[str]:
+    words = para.split()
+    if not words:
+        return [""]
+    s = " ".join(words)
+    # the epsilon absorbs float drift between the glyph-table sums and stringWidth, so exact fits still fit
+    max_width += 1e-9
+    if fast_width(s, FONT, fs) <= max_width:
+        return [s]
+    cw = _char_widths(FONT)
+    limit = max_width * 1000 / fs
+    cum = [0.0, *accumulate(cw[o] if o < 128 else stringWidth(chr(o), FONT, 1000) for o in map(ord, s))]
     out: List[str] = []
-    for para in (text or "").split("\n"):
-        words = para.split()
-        if not words:
-            out.append("")
-            continue
-        cur = ""
-        for w in words:
-            t = w if not cur else f"{cur} {w}"
-            if c0.stringWidth(t, FONT, fs) <= max_width:
-                cur = t
-            else:
-                if cur:
-                    out.append(cur)
-                cur = w
-        if cur:
-            out.append(cur)
+    a, n = 0, len(s)
+    while a < n:
+        p = bisect_right(cum, cum[a] + limit) - 1
+        if p >= n:
+            out.append(s[a:])
+            break
+        e = s.rfind(" ", a, p + 1)
+        if e <= a:
+            e = s.find(" ", a)
+            if e < 0:
+                e = n
+        while fast_width(s[a:e], FONT, fs) > max_width and s.rfind(" ", a, e) > a:
+            e = s.rfind(" ", a, e)
+        out.append(s[a:e])
+        a = e + 1
     return out
 
-def fetch_image(url: str, max_w: int = 1200, max_h: int = 900) -> Optional[ImageReader]:
+@lru_cache(maxsize=4096)
+def _wrap_cached(text: str, max_width: float, fs: float) -> Tuple[str, ...]:
+    out: List[str] = []
+    for para in text.split("\n"):
+        out.extend(_wrap_para(para, max_width, fs))
+    return tuple(out)
+
+def wrap_lines(text: str, max_width: float, fs: float) -> List[str]:
+    return list(_wrap_cached(text or "", max_width, fs))
+
+def _flatten(img: Image.Image) -> Image.Image:
+    rgb = Image.new("RGB", img.size, (255, 255, 255))
+    rgb.paste(img, mask=img.getchannel("A"))
+    return rgb
+
+def decode_image(data: bytes, max_w: int = 1200, max_h: int = 900) -> Optional[ImageReader]:
     try:
-        r = requests.get(url, timeout=REQUEST_TIMEOUT, stream=True)
-        if r.status_code != 200:
-            return None
-        cl = r.headers.get("content-length")
-        if cl and int(cl) > 5_000_000 and SKIP_LARGE_IMAGES:
-            return None
-        img = Image.open(BytesIO(r.content))
-        if img.mode in ("RGBA", "LA", "P"):
-            rgb = Image.new("RGB", img.size, (255, 255, 255))
-            if img.mode == "P":
-                img = img.convert("RGBA")
-            rgb.paste(img, mask=img.split()[-1] if img.mode in ("RGBA", "LA") else None)
-            img = rgb
+        img = Image.open(BytesIO(data))
+        # JPEGs that already fit are embedded as-is (DCT passthrough): no decode, no re-encode
+        if img.format == "JPEG" and img.mode in ("RGB", "L") and img.width <= max_w and img.height <= max_h:
+            return ImageReader(BytesIO(data))
+        img.draft("RGB", (max_w * 2, max_h * 2))
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        if img.mode in ("RGBA", "LA"):
+            lo, _ = img.getchannel("A").getextrema()
+            img = img.convert("RGB") if lo == 255 else _flatten(img)
         img.thumbnail((max_w, max_h), Image.Resampling.LANCZOS)
+        # hand ReportLab JPEG bytes so it embeds them as DCT instead of Flate-packing raw pixels
         buf = BytesIO()
-        img.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        img.save(buf, format="JPEG", quality=JPEG_QUALITY)
         buf.seek(0)
-        return ImageReader(Image.open(buf))
+        return ImageReader(buf)
+    except Exception:
+        return None
+
+def fetch_image(url: str, max_w: int = 1200, max_h: int = 900) -> Optional[ImageReader]:
+    try:
+        with _SESSION.get(url, timeout=REQUEST_TIMEOUT, stream=True) as r:
+            if r.status_code != 200:
+                return None
+            cl = r.headers.get("content-length")
+            if cl and int(cl) > MAX_IMAGE_BYTES and SKIP_LARGE_IMAGES:
+                return None
+            buf = BytesIO()
+            for chunk in r.iter_content(65536):
+                buf.write(chunk)
+                if buf.tell() > MAX_IMAGE_BYTES and SKIP_LARGE_IMAGES:
+                    return None
     except Exception:
         return None
+    return decode_image(buf.getvalue(), max_w, max_h)
+
+async def _fetch_bytes(session, url: str) -> Optional[bytes]:
+    try:
+        async with session.get(url) as r:
+            if r.status != 200:
+                return None
+            if (r.content_length or 0) > MAX_IMAGE_BYTES and SKIP_LARGE_IMAGES:
+                return None
+            buf = bytearray()
+            async for chunk in r.content.iter_chunked(65536):
+                buf.extend(chunk)
+                if len(buf) > MAX_IMAGE_BYTES and SKIP_LARGE_IMAGES:
+                    return None
+            return bytes(buf)
+    except Exception:
+        return None
+
+async def _fetch_images_async(urls: List[str]) -> Dict[str, Optional[ImageReader]]:
+    # all GETs share one event loop thread; only the PIL decode goes to worker threads
+    loop = asyncio.get_running_loop()
+    timeout = aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1])
+    connector = aiohttp.TCPConnector(limit=MAX_MEDIA_THREADS * 2)
+    with ThreadPoolExecutor(max_workers=min(MAX_MEDIA_THREADS, len(urls))) as pool:
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector, headers={"Accept-Encoding": "identity"}) as session:
+            async def one(url: str) -> Optional[ImageReader]:
+                data = await _fetch_bytes(session, url)
+                if data is None:
+                    return None
+                return await loop.run_in_executor(pool, decode_image, data)
+            imgs = await asyncio.gather(*(one(url) for url in urls))
+    return dict(zip(urls, imgs))
+
+def _in_event_loop() -> bool:
+    # asyncio.run() refuses to nest, so callers already on a loop (async handlers, Jupyter) use threads
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def _fetch_images_threaded(urls: List[str]) -> Dict[str, Optional[ImageReader]]:
+    with ThreadPoolExecutor(max_workers=min(MAX_MEDIA_THREADS, len(urls))) as pool:
+        return dict(zip(urls, pool.map(fetch_image, urls)))
 
 def extract(data: Dict[str, Any]):
     head = {
@@ -124,6 +270,10 @@ def extract(data: Dict[str, Any]):
     for section in (data.get("sections") or []):
         sname = section.get("name") or ""
         snum = section.get("sectionNumber") or ""
+        try:
+            sortkey = (int(snum), sname)
+        except (TypeError, ValueError):
+            sortkey = (9999, sname)
         for li in (section.get("lineItems") or []):
             status = (li.get("inspectionStatus") or "").upper()
             title = (li.get("title") or li.get("name") or "").strip()
@@ -131,7 +281,7 @@ def extract(data: Dict[str, Any]):
             for cmt in (li.get("comments") or []):
                 text = (cmt.get("commentText") or cmt.get("text") or "").strip()
                 if text:
-                    paragraphs.append(html.unescape(text))
+                    paragraphs.append(html.unescape(text) if "&" in text else text)
                 for ph in (cmt.get("photos") or []):
                     url = ph if isinstance(ph, str) else (ph.get("url") if isinstance(ph, dict) else None)
                     if url:
@@ -145,16 +295,14 @@ def extract(data: Dict[str, Any]):
             body = "\n\n".join(paragraphs).strip()
             if mrefs:
                 body = (body + ("\n\n" if body else "") + " ".join(f"[M#{i}]" for i in mrefs)).strip()
-            items.append({"section": sname, "sectionNumber": snum, "title": title, "status": status, "text": body})
+            items.append({"section": sname, "sectionNumber": snum, "title": title, "status": status, "text": body, "_sortkey": sortkey})
     return head, items, media
 
 def status_color(code: str) -> Color:
-    if code == "D": return COLOR_D
-    if code == "NI": return COLOR_NI
-    if code == "NP": return COLOR_NP
-    return COLOR_I
+    return _STATUS_COLORS.get(code, COLOR_I)
 
-def build_media_map(media: List[Dict[str, str]]):
+def build_media_map(media: List[Dict[str, str]], refs: Optional[set] = None):
+    # refs: the [M#n] indices the report text actually draws; anything else (e.g. the header image) is not fetched
     out: Dict[int, Dict[str, Any]] = {}
     if not media:
         return out
@@ -164,21 +312,28 @@ def build_media_map(media: List[Dict[str, str]]):
         url = m.get("url", "")
         entry = {"kind": kind, "url": url, "img": None}
         out[i] = entry
-        if kind == "photo" and url:
+        if kind == "photo" and url and (refs is None or i in refs):
             photo_targets.setdefault(url, []).append(i)
+    for url in list(photo_targets):
+        img = _IMG_CACHE.get(url)
+        if img is not None:
+            _IMG_CACHE.move_to_end(url)
+            for idx in photo_targets.pop(url):
+                out[idx]["img"] = img
     if not photo_targets:
         return out
-    workers = min(MAX_MEDIA_THREADS, len(photo_targets))
-    with ThreadPoolExecutor(max_workers=workers) as pool:
-        future_map = {pool.submit(fetch_image, url): url for url in photo_targets}
-        for future in as_completed(future_map):
-            url = future_map[future]
-            try:
-                img = future.result()
-            except Exception:
-                img = None
-            for idx in photo_targets[url]:
-                out[idx]["img"] = img
+    urls = list(photo_targets)
+    if aiohttp is not None and not _in_event_loop():
+        fetched = asyncio.run(_fetch_images_async(urls))
+    else:
+        fetched = _fetch_images_threaded(urls)
+    for url, img in fetched.items():
+        for idx in photo_targets[url]:
+            out[idx]["img"] = img
+        if img is not None:
+            _IMG_CACHE[url] = img
+            if len(_IMG_CACHE) > IMG_CACHE_SIZE:
+                _IMG_CACHE.popitem(last=False)
     return out
 
 def draw_header(c: canvas.Canvas, client: str, addr: str, date: str, inspector: str):
@@ -191,48 +346,56 @@ def draw_header(c: canvas.Canvas, client: str, addr: str, date: str, inspector:
     c.setFillColor(COLOR_ACCENT); c.setFont(FONT_B, 12); c.drawString(MARGIN, H-128, f"Inspector: {inspector}  |  Client: {client}")
     c.setFillColor(black)
 
-def draw_cover_image(c: canvas.Canvas):
+@lru_cache(maxsize=1)
+def _cover_reader(draft_size: Tuple[int, int]) -> Optional[ImageReader]:
+    # decoded once per process; batch renders reuse it
     if not COVER_IMAGE_PATH.exists():
-        return
+        return None
     try:
-        with Image.open(COVER_IMAGE_PATH) as raw_img:
-            img = raw_img if raw_img.mode in ("RGB", "L") else raw_img.convert("RGB")
-            iw, ih = img.size
-            if iw == 0 or ih == 0:
-                return
-            max_w = W - 2 * MARGIN
-            top = H - 140 - 24
-            available_h = top - MARGIN
-            if available_h <= 0 or max_w <= 0:
-                return
-            scale = min(max_w / iw, available_h / ih, 1.0)
-            draw_w, draw_h = iw * scale, ih * scale
-            x = MARGIN + (max_w - draw_w) / 2
-            y = top - draw_h
-            if y < MARGIN:
-                y = MARGIN
-            c.drawImage(ImageReader(img), x, y, width=draw_w, height=draw_h, preserveAspectRatio=True, mask='auto')
+        img = Image.open(COVER_IMAGE_PATH)
+        img.draft("RGB", draft_size)
+        img = img if img.mode in ("RGB", "L") else img.convert("RGB")
+        img.load()
+        return ImageReader(img)
     except Exception:
+        return None
+
+def draw_cover_image(c: canvas.Canvas):
+    max_w = W - 2 * MARGIN
+    top = H - 140 - 24
+    available_h = top - MARGIN
+    if available_h <= 0 or max_w <= 0:
+        return
+    img = _cover_reader((int(max_w) * 2, int(available_h) * 2))
+    if img is None:
         return
+    iw, ih = img.getSize()
+    if iw == 0 or ih == 0:
+        return
+    scale = min(max_w / iw, available_h / ih, 1.0)
+    draw_w, draw_h = iw * scale, ih * scale
+    x = MARGIN + (max_w - draw_w) / 2
+    y = top - draw_h
+    if y < MARGIN:
+        y = MARGIN
+    c.drawImage(img, x, y, width=draw_w, height=draw_h, mask='auto')
 
 def footer(c: canvas.Canvas, page_label: str = ""):
     c.setFont(FONT, 9); c.setFillColor(COLOR_MUTED)
     c.drawString(MARGIN, 24, page_label)
-    c.drawRightString(W-MARGIN, 24, f"Page {c.getPageNumber()}")
+    if _footer_page_numbers:
+        c.drawRightString(W-MARGIN, 24, f"Page {c.getPageNumber()}")
     c.setFillColor(black)
 
 def new_page(c: canvas.Canvas, page_label: str = ""):
     footer(c, page_label); c.showPage()
 
-def draw_exec_summary(c: canvas.Canvas, head, items):
+def draw_exec_summary(c: canvas.Canvas, head, items, counts: Dict[str, int]):
     c.bookmarkPage("exec")
     c.addOutlineEntry("Executive Summary", "exec", level=0, closed=False)
     c.setFont(FONT_B, H2_FS); c.setFillColor(COLOR_BG); c.drawString(MARGIN, H-MARGIN-10, "Executive Summary")
     c.setFillColor(black)
     y = H-MARGIN-10-LH-6
-    counts = {"I":0,"NI":0,"NP":0,"D":0}
-    for it in items:
-        counts[it.get("status","I")] = counts.get(it.get("status","I"),0)+1
     bar_total = max(1, sum(counts.values()))
     bar_w = W - 2*MARGIN
     bar_h = 12
@@ -260,46 +423,50 @@ def draw_exec_summary(c: canvas.Canvas, head, items):
         y -= LH
     return
 
-def section_key(it): 
-    sn = it.get("sectionNumber","")
-    try:
-        return (int(sn), it.get("section",""))
-    except:
-        return (9999, it.get("section",""))
+def toc_page_count(n_entries: int) -> int:
+    pages, y = 1, H-MARGIN-10-LH
+    for _ in range(n_entries):
+        if y < 80:
+            pages += 1; y = H-MARGIN
+        y -= TOC_ROW
+    return pages
 
-def draw_toc(c: canvas.Canvas, toc_entries: List[Tuple[str,int,str]]):
-    c.bookmarkPage("toc")
-    c.addOutlineEntry("Table of Contents", "toc", level=0, closed=False)
+def draw_toc(c: canvas.Canvas, toc_entries: List[Tuple[str,int]]) -> List[Tuple[int, Tuple[float,float,float,float], int]]:
     c.setFont(FONT_B, H2_FS); c.setFillColor(COLOR_BG); c.drawString(MARGIN, H-MARGIN-10, "Table of Contents")
     c.setFillColor(black)
     y = H-MARGIN-10-LH
     c.setFont(FONT, 11)
-    for title, page, dest in toc_entries:
+    links = []
+    for title, page in toc_entries:
         if y < 80:
             new_page(c, "Table of Contents"); y = H-MARGIN
+            c.setFont(FONT, 11)
         text = f"{title}"
-        tw = c.stringWidth(text, FONT, 11)
+        tw = fast_width(text, FONT, 11)
         c.drawString(MARGIN, y, text)
-        dots = "." * max(2, int((W - MARGIN*2 - tw - 40) / c.stringWidth(".", FONT, 11)))
+        dots = MAX_DOTS[:max(2, int((W - MARGIN*2 - tw - 40) / DOT_W11))]
         c.drawString(MARGIN+tw+4, y, dots)
         pn = str(page)
         c.drawRightString(W-MARGIN, y, pn)
-        c.linkAbsolute("", dest, (MARGIN, y-2, MARGIN+tw, y+10))
+        links.append((c.getPageNumber(), (MARGIN, y-2, MARGIN+tw, y+10), page))
         y -= TOC_ROW
+    return links
 
 def draw_inline(c: canvas.Canvas, text: str, x: float, y: float, width: float, media_map: Dict[int, Dict[str, Any]], render_media: bool = True) -> float:
     def draw_wrapped(chunk: str, y0: float) -> float:
         if not chunk: return y0
-        for ln in wrap_lines(chunk, c, width, FS):
+        c.setFont(FONT, FS)
+        for ln in wrap_lines(chunk, width, FS):
             if y0 < 72:
                 new_page(c, cur_label[0]); y0 = H - MARGIN
             c.drawString(x, y0, ln); y0 -= LH
         return y0
-    pos = 0
-    for m in MEDIA_TOKEN_RE.finditer(text or ""):
-        pre = text[pos:m.start()]
-        y = draw_wrapped(pre, y)
-        idx = int(m.group(1))
+    parts = MEDIA_TOKEN_RE.split(text or "")
+    for lit, tok in zip(parts[0::2], parts[1::2] + [None]):
+        y = draw_wrapped(lit, y)
+        if tok is None:
+            break
+        idx = int(tok)
         meta = media_map.get(idx)
         if y < 88:
             new_page(c, cur_label[0]); y = H - MARGIN
@@ -308,31 +475,25 @@ def draw_inline(c: canvas.Canvas, text: str, x: float, y: float, width: float, m
         else:
             if meta.get("kind") == "photo" and meta.get("img"):
                 img = meta["img"]
-                try:
-                    iw, ih = getattr(img, "_image", getattr(img, "image", None)).size
-                except Exception:
-                    iw, ih = (800, 600)
+                iw, ih = img.getSize()
                 scale = min(width/iw, INLINE_IMG_MAX_H/ih)
                 rw, rh = iw*scale, ih*scale
                 if y - rh - 16 < 72:
                     new_page(c, cur_label[0]); y = H - MARGIN
                 c.setFont(FONT_B, 10); c.drawString(x, y, f"M#{idx}: photo"); y -= 12
                 if render_media:
-                    c.drawImage(img, x, y - rh, width=rw, height=rh, preserveAspectRatio=True, mask='auto')
+                    c.drawImage(img, x, y - rh, width=rw, height=rh, mask='auto')
                 y = y - rh - 8; c.setFont(FONT, FS)
             elif meta.get("kind") == "video":
                 label = f"Video M#{idx}"
                 c.setFont(FONT_B, 10); c.setFillColor(HexColor("#0645AD")); c.drawString(x, y, label)
-                tw = c.stringWidth(label, FONT_B, 10)
+                tw = fast_width(label, FONT_B, 10)
                 url = meta.get("url") or ""
                 if url:
                     c.linkURL(url, (x, y-2, x+tw, y+10), relative=0)
                 c.setFillColor(black); y -= LH; c.setFont(FONT, FS)
             else:
                 c.setFont(FONT_B, 10); c.drawString(x, y, f"M#{idx}: (unavailable)"); y -= LH; c.setFont(FONT, FS)
-        pos = m.end()
-    tail = (text or "")[pos:]
-    y = draw_wrapped(tail, y)
     return y
 
 def draw_item_card(c: canvas.Canvas, it: Dict[str, Any], x: float, y: float, width: float, media_map, render_media: bool = True) -> float:
@@ -342,7 +503,7 @@ def draw_item_card(c: canvas.Canvas, it: Dict[str, Any], x: float, y: float, wid
     card_w = width
     title_h = 16
     band_w = 6
-    lines = wrap_lines(title, c, card_w - band_w - 2*CARD_PAD, 11.5)
+    lines = wrap_lines(title, card_w - band_w - 2*CARD_PAD, 11.5)
     content_h = LH * max(1, len(lines)) + 10
     y0 = y
     if y - (content_h + 10) < 72:
@@ -360,130 +521,176 @@ def draw_item_card(c: canvas.Canvas, it: Dict[str, Any], x: float, y: float, wid
         ty = draw_inline(c, txt, x + band_w + CARD_PAD, ty, card_w - band_w - 2*CARD_PAD, media_map, render_media=render_media)
     return ty - GAP
 
+def define_status_key_form(c: canvas.Canvas):
+    # the legend under every section title never changes: draw it once as a form XObject, place it with doForm
+    y = H - MARGIN - 10 - LH
+    c.beginForm(STATUS_KEY_FORM)
+    c.setFont(FONT, 10); c.setFillColor(COLOR_MUTED)
+    c.drawString(MARGIN, y, "Status key: ")
+    xk = MARGIN + fast_width("Status key: ", FONT, 10) + 6
+    for lab, code in [("D","D"),("NI","NI"),("I","I"),("NP","NP")]:
+        c.setFillColor(status_color(code)); c.rect(xk, y-8, 10, 10, fill=1, stroke=0)
+        c.setFillColor(black); c.drawString(xk+14, y-6, lab)
+        xk += 44
+    c.endForm()
+
+def _render_sections(keys: List[str], groups: Dict[str, List[Dict[str, Any]]], media_map: Dict[int, Dict[str, Any]], first_page: Optional[int]) -> Tuple[bytes, List[int]]:
+    # first_page=None: the start page is not known yet, footers are numbered later by _stamp_page_numbers
+    global cur_label, _footer_page_numbers
+    _footer_page_numbers = first_page is not None
+    buf = BytesIO()
+    c = canvas.Canvas(buf, pagesize=PAGE_SIZE)
+    if first_page is not None:
+        c._pageNumber = first_page
+    define_status_key_form(c)
+    page_counts: List[int] = []
+    for key in keys:
+        start = c.getPageNumber()
+        dest = f"sec::{key}"
+        c.bookmarkPage(dest)
+        c.addOutlineEntry(key, dest, level=0, closed=False)
+        c.setFont(FONT_B, H2_FS); c.setFillColor(COLOR_BG); c.drawString(MARGIN, H-MARGIN-10, key)
+        c.setFillColor(black)
+        y = H - MARGIN - 10 - LH
+        c.doForm(STATUS_KEY_FORM)
+        y -= LH + 4
+        cur_label = (key,)
+        for it in groups[key]:
+            y = draw_item_card(c, it, MARGIN, y, W - 2*MARGIN, media_map)
+            if y < 100:
+                new_page(c, key); y = H - MARGIN
+        footer(c, key); c.showPage()
+        page_counts.append(c.getPageNumber() - start)
+    c.save()
+    _footer_page_numbers = True
+    return buf.getvalue(), page_counts
+
+def _light_media(items: List[Dict[str, Any]], media_map: Dict[int, Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+    # only the entries these items reference, with the PIL image (or passthrough JPEG bytes) instead of
+    # the ImageReader so it pickles
+    out: Dict[int, Dict[str, Any]] = {}
+    for it in items:
+        for tok in MEDIA_TOKEN_RE.findall(it.get("text", "")):
+            meta = media_map.get(int(tok))
+            if meta:
+                img = meta.get("img")
+                if img is not None:
+                    fh = img.jpeg_fh()
+                    img = fh.getvalue() if fh is not None else img._image
+                out[int(tok)] = {**meta, "img": img}
+    return out
+
+def _render_sections_worker(keys: List[str], groups: Dict[str, List[Dict[str, Any]]], light_media: Dict[int, Dict[str, Any]]) -> Tuple[bytes, List[int]]:
+    def reader(img):
+        if img is None:
+            return None
+        return ImageReader(BytesIO(img) if isinstance(img, bytes) else img)
+    media_map = {idx: {**meta, "img": reader(meta.get("img"))} for idx, meta in light_media.items()}
+    return _render_sections(keys, groups, media_map, None)
+
+def _stamp_page_numbers(writer: PdfWriter, start_index: int):
+    buf = BytesIO()
+    c = canvas.Canvas(buf, pagesize=PAGE_SIZE)
+    for n in range(start_index + 1, len(writer.pages) + 1):
+        c.setFont(FONT, 9); c.setFillColor(COLOR_MUTED)
+        c.drawRightString(W-MARGIN, 24, f"Page {n}")
+        c.showPage()
+    c.save(); buf.seek(0)
+    for i, pg in enumerate(PdfReader(buf).pages):
+        writer.pages[start_index + i].merge_page(pg)
+
+def optimize_pdf(out_path: Path) -> bool:
+    # object streams + linearization via libqpdf (pikepdf) or the qpdf binary; left as-is when neither exists
+    if pikepdf is not None:
+        with pikepdf.open(out_path, allow_overwriting_input=True) as pdf:
+            pdf.save(out_path, linearize=True, object_stream_mode=pikepdf.ObjectStreamMode.generate, compress_streams=True)
+        return True
+    if shutil.which("qpdf"):
+        tmp = out_path.with_name(out_path.name + ".opt")
+        # qpdf exits 3 for warnings, which still produce a usable file
+        if subprocess.run(["qpdf", "--linearize", "--object-streams=generate", str(out_path), str(tmp)]).returncode in (0, 3):
+            os.replace(tmp, out_path)
+            return True
+        tmp.unlink(missing_ok=True)
+    return False
+
 def render_report(data: Dict[str, Any], out_path: Path):
     t_start = time.perf_counter()
     head, items, media = extract(data)
-    media_map = build_media_map(media)
+    media_map = build_media_map(media, {int(tok) for it in items for tok in MEDIA_TOKEN_RE.findall(it["text"])})
     t_after_media = time.perf_counter()
+    # one pass builds both the section groups and the status counts; only the section keys need sorting
     groups: Dict[str, List[Dict[str,Any]]] = {}
-    order_keys: List[str] = []
-    for it in sorted(items, key=section_key):
-        k = f"{it.get('sectionNumber','')}. {it.get('section','')}".strip(". ")
-        if k not in groups:
-            groups[k] = []
-            order_keys.append(k)
-        groups[k].append(it)
-
-    section_pages: Dict[str,int] = {}
-    toc_page_number = 0
+    counts = {"I":0,"NI":0,"NP":0,"D":0}
+    for it in items:
+        counts[it["status"]] = counts.get(it["status"],0)+1
+        groups.setdefault(f"{it['sectionNumber']}. {it['section']}".strip(". "), []).append(it)
+    order_keys = sorted(groups, key=lambda k: groups[k][0]["_sortkey"])
 
-    def doc(pass_collect: bool, render_media: bool) -> BytesIO:
-        nonlocal toc_page_number
-        buf = BytesIO()
-        c = canvas.Canvas(buf, pagesize=PAGE_SIZE)
-        draw_header(c, head["client"], head["address"], head["date"], head["inspector"])
-        draw_cover_image(c)
-        c.bookmarkPage("cover")
-        c.addOutlineEntry("Cover", "cover", level=0, closed=False)
-        footer(c, "Cover"); c.showPage()
-
-        c.setFont(FONT_B, H2_FS); c.setFillColor(COLOR_BG); c.drawString(MARGIN, H-MARGIN-10, "Executive Summary")
-        c.setFillColor(black)
-        draw_exec_summary(c, head, items)
-        footer(c, "Executive Summary"); c.showPage()
+    front_buf = BytesIO()
+    c = canvas.Canvas(front_buf, pagesize=PAGE_SIZE)
+    draw_header(c, head["client"], head["address"], head["date"], head["inspector"])
+    draw_cover_image(c)
+    c.bookmarkPage("cover")
+    c.addOutlineEntry("Cover", "cover", level=0, closed=False)
+    footer(c, "Cover"); c.showPage()
 
-        toc_start_page = c.getPageNumber()
-        c.setFont(FONT_B, H2_FS); c.setFillColor(COLOR_BG); c.drawString(MARGIN, H-MARGIN-10, "Table of Contents")
-        c.setFillColor(black)
-        footer(c, "Table of Contents"); c.showPage()
-        if pass_collect:
-            toc_page_number = toc_start_page
-
-        for key in order_keys:
-            dest = f"sec::{key}"
-            c.bookmarkPage(dest)
-            c.addOutlineEntry(key, dest, level=0, closed=False)
-            if pass_collect and key not in section_pages:
-                section_pages[key] = c.getPageNumber()
-            c.setFont(FONT_B, H2_FS); c.setFillColor(COLOR_BG); c.drawString(MARGIN, H-MARGIN-10, key)
-            c.setFillColor(black)
-            y = H - MARGIN - 10 - LH
-            c.setFont(FONT, 10); c.setFillColor(COLOR_MUTED)
-            c.drawString(MARGIN, y, "Status key: "); 
-            xk = MARGIN + c.stringWidth("Status key: ", FONT, 10) + 6
-            for lab, code in [("D","D"),("NI","NI"),("I","I"),("NP","NP")]:
-                c.setFillColor(status_color(code)); c.rect(xk, y-8, 10, 10, fill=1, stroke=0)
-                c.setFillColor(black); c.drawString(xk+14, y-6, lab)
-                xk += 44
-            c.setFillColor(black)
-            y -= LH + 4
-            global cur_label
-            cur_label = (key,)
-            for it in groups[key]:
-                y = draw_item_card(c, it, MARGIN, y, W - 2*MARGIN, media_map, render_media=render_media)
-                if y < 100:
-                    new_page(c, key); y = H - MARGIN
-            footer(c, key); c.showPage()
-        buf.seek(0)
-        c.save()
-        buf.seek(0)
-        return buf
+    c.setFont(FONT_B, H2_FS); c.setFillColor(COLOR_BG); c.drawString(MARGIN, H-MARGIN-10, "Executive Summary")
+    c.setFillColor(black)
+    draw_exec_summary(c, head, items, counts)
+    footer(c, "Executive Summary"); c.showPage()
+    toc_index = c.getPageNumber() - 1
+    c.save(); front_buf.seek(0)
 
-    first_pass_buf = doc(True, render_media=True)
+    # sections always start on a fresh page, so contiguous runs of them can be laid out independently
+    first_body_page = toc_index + toc_page_count(len(order_keys)) + 1
+    workers = min(RENDER_WORKERS, len(order_keys))
+    if workers > 1:
+        step = -(-len(order_keys) // workers)
+        chunks = [order_keys[i:i+step] for i in range(0, len(order_keys), step)]
+        with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+            rendered = list(pool.map(
+                _render_sections_worker,
+                chunks,
+                [{k: groups[k] for k in keys} for keys in chunks],
+                [_light_media([it for k in keys for it in groups[k]], media_map) for keys in chunks],
+            ))
+    else:
+        rendered = [_render_sections(order_keys, groups, media_map, first_body_page)]
     t_after_first_pass = time.perf_counter()
-    toc_entries = [(k, section_pages.get(k, 1), f"sec::{k}") for k in order_keys]
 
-    reader = PdfReader(first_pass_buf)
-    toc_page_index = max(0, toc_page_number - 1) if toc_entries else 0
-    link_rects: List[Tuple[tuple[float, float, float, float], int]] = []
+    section_pages: Dict[str,int] = {}
+    page = first_body_page
+    for key, n_pages in zip(order_keys, (n for _, counts in rendered for n in counts)):
+        section_pages[key] = page
+        page += n_pages
+    toc_entries = [(k, section_pages[k]) for k in order_keys]
 
-    if toc_entries:
-        buf_overlay = BytesIO()
-        overlay = canvas.Canvas(buf_overlay, pagesize=PAGE_SIZE)
-        overlay.setFillColor(black)
-        overlay.setFont(FONT, 11)
-        y = H - MARGIN - 10 - LH
-        for title, page_no, dest in toc_entries:
-            if y < 80:
-                buf_overlay = None
-                break
-            text = f"{title}"
-            tw = overlay.stringWidth(text, FONT, 11)
-            overlay.drawString(MARGIN, y, text)
-            dots_count = max(2, int((W - MARGIN*2 - tw - 40) / overlay.stringWidth(".", FONT, 11)))
-            overlay.drawString(MARGIN + tw + 4, y, "." * dots_count)
-            overlay.drawRightString(W - MARGIN, y, str(page_no))
-            link_rects.append(((MARGIN, y-2, MARGIN + tw, y + 10), page_no - 1))
-            y -= TOC_ROW
-        if buf_overlay is None:
-            reader = PdfReader(doc(False, render_media=True))
-            link_rects = []
-        else:
-            overlay.save(); buf_overlay.seek(0)
-            overlay_reader = PdfReader(buf_overlay)
-            target_page = reader.pages[toc_page_index]
-            target_page.merge_page(overlay_reader.pages[0])
-            from pypdf.generic import NameObject, ArrayObject
-            from pypdf.annotations import Link
-            annot_key = NameObject("/Annots")
-            existing_annots = target_page.get(annot_key)
-            if existing_annots is None:
-                annots_array = ArrayObject()
-            else:
-                annots_array = ArrayObject(existing_annots)
-            for rect, target_idx in link_rects:
-                annots_array.append(Link(rect=rect, target_page_index=target_idx))
-            target_page[annot_key] = annots_array
+    toc_buf = BytesIO()
+    toc = canvas.Canvas(toc_buf, pagesize=PAGE_SIZE)
+    toc._pageNumber = toc_index + 1
+    links = draw_toc(toc, toc_entries)
+    footer(toc, "Table of Contents"); toc.showPage()
+    toc.save(); toc_buf.seek(0)
 
+    # every piece is a fresh ReportLab document, so append pages instead of deep-cloning a whole tree
     writer = PdfWriter()
-    writer.clone_document_from_reader(reader)
+    writer.append(front_buf)
+    writer.append(toc_buf, import_outline=False)
+    for pdf, _ in rendered:
+        writer.append(BytesIO(pdf))
+    if workers > 1:
+        _stamp_page_numbers(writer, first_body_page - 1)
+    for page_no, rect, target_page in links:
+        writer.add_annotation(page_number=page_no - 1, annotation=Link(rect=rect, target_page_index=target_page - 1))
     root = writer._root_object
     acro = root.get("/AcroForm")
     if acro is not None:
-        from pypdf.generic import NameObject, BooleanObject
         acro.update({NameObject("/NeedAppearances"): BooleanObject(False)})
-    with open(out_path, "wb") as f:
+    with open(out_path, "wb", buffering=WRITE_BUFFER) as f:
         writer.write(f)
+    if OPTIMIZE_PDF and not optimize_pdf(out_path):
+        print("⚠️ OPTIMIZE_PDF=1 but neither pikepdf nor qpdf is available; output left unoptimized")
     t_end = time.perf_counter()
     if DEBUG_TIMING:
         print(f"[timing] media_map={t_after_media - t_start:.2f}s, render={t_after_first_pass - t_after_media:.2f}s, total={t_end - t_after_media:.2f}s")
@@ -494,8 +701,7 @@ def main():
     here = Path(__file__).parent
     json_path = Path(os.environ.get("JSON_PATH", here / "inspection.json"))
     out_path = Path(os.environ.get("OUT_PATH", here / "bonus_pdf.pdf"))
-    with open(json_path, "r", encoding="utf-8") as fp:
-        root = json.load(fp)
+    root = _json_loads(json_path.read_bytes())
     data = root.get("inspection", root)
     render_report(data, out_path)
     dt = time.time() - t0
@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 # TREC Inspection Report PDF Generator — header-first overlay + overlap-safe body with INLINE MEDIA (optimized)
-import os, json, re, time, html
+import os, json, re, time, html, argparse, threading, math
 from pathlib import Path
 from io import BytesIO
-from typing import Dict, Any, List, Tuple, Optional
+from typing import Dict, Any, List, Tuple, Optional, Callable
 from datetime import datetime, timezone
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, OrderedDict
+from functools import lru_cache
 
 from pypdf import PdfReader, PdfWriter
 from pypdf.generic import NameObject, BooleanObject, ArrayObject
@@ -18,9 +20,11 @@ from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase.pdfmetrics import stringWidth
 
 from PIL import Image
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # =============== Config ===============
 FIXED_FONT = "Helvetica"
@@ -33,11 +37,26 @@ BOT_PAD = 6
 
 MAX_IMAGE_SIZE = (800, 600)
 JPEG_QUALITY = 75
+JPEG_OPTIMIZE = os.environ.get("JPEG_OPTIMIZE", "0") == "1"  # optimal Huffman tables: ~3x encode time, ~1% on photos
 SKIP_LARGE_IMAGES = True  # skip >5MB
+MAX_IMAGE_BYTES = 5_000_000
+WRITE_BUFFER = 1 << 20  # pypdf issues many small writes; batch them into 1 MiB chunks
 
 INLINE_IMG_MAX_H = 2.4 * inch
+IMG_WORKERS = int(os.environ.get("IMG_WORKERS", "6"))
+IMG_CACHE_SIZE = 256
 
 I, NI, NP, D = "I", "NI", "NP", "D"
+# PDF names compared or written for every widget; built once rather than per lookup
+NM_ANNOTS, NM_TX, NM_BTN, NM_V, NM_AS, NM_OFF, NM_NEED_APPS = (
+    NameObject(s) for s in ("/Annots", "/Tx", "/Btn", "/V", "/AS", "/Off", "/NeedAppearances"))
+OFF_STATE = {NM_V: NM_OFF, NM_AS: NM_OFF}
+
+# one bound comment field: its widget /Rect as floats, the comment text, and the source item
+Overlay = namedtuple("Overlay", "rect text item")
+
+# fetched photos by URL, kept across reports in one process (LRU, successes only)
+_IMG_CACHE: "OrderedDict[str, Tuple[ImageReader, Tuple[int, int]]]" = OrderedDict()
 
 # =============== Utils ===============
 def ms_to_iso(ms):
@@ -45,17 +64,32 @@ def ms_to_iso(ms):
         return datetime.fromtimestamp(ms/1000.0, tz=timezone.utc).date().isoformat()
     return "Data not found in test data"
 
+def _compile_path(path: str) -> Callable[[Any], Any]:
+    keys = tuple(path.split("."))
+    def get(cur):
+        for k in keys:
+            if not isinstance(cur, dict):
+                return None
+            cur = cur.get(k)
+        return cur
+    return get
+
+ACC: Dict[str, Callable[[Any], Any]] = {p: _compile_path(p) for p in (
+    "address.fullAddress", "address.street", "address.city", "address.state", "address.zipcode",
+    "clientInfo.name", "schedule.date", "inspector.name", "inspector.license",
+)}
+
 def getv(doc: Dict[str, Any], path: str, default="Data not found in test data"):
-    cur = doc
-    for k in path.split("."):
-        if isinstance(cur, dict) and k in cur:
-            cur = cur[k]
-        else:
-            return default
+    acc = ACC.get(path)
+    if acc is None:
+        acc = ACC[path] = _compile_path(path)
+    cur = acc(doc)
     return cur if cur not in ("", None) else default
 
+_NORM_RE = re.compile(r"[^a-z0-9]+")
+
 def normalize(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
+    return _NORM_RE.sub("", (s or "").lower())
 
 def rect_coords(rect) -> Dict[str, float]:
     return {
@@ -88,9 +122,10 @@ def extract_header_data(data: Dict[str, Any]) -> Dict[str, str]:
 
 def extract_items_and_media(data: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[Dict[str, str]]]:
     items, media = [], []
+    add_item, add_media = items.append, media.append
     cover = data.get("headerImageUrl")
     if isinstance(cover, str) and cover.strip():
-        media.append({"kind": "photo", "url": cover.strip()})
+        add_media({"kind": "photo", "url": cover.strip()})
     for section in (data.get("sections") or []):
         sname = section.get("name") or ""
         snum = section.get("sectionNumber") or ""
@@ -101,21 +136,21 @@ def extract_items_and_media(data: Dict[str, Any]) -> Tuple[List[Dict[str, Any]],
             for cmt in (li.get("comments") or []):
                 text = (cmt.get("commentText") or cmt.get("text") or "").strip()
                 if text:
-                    paragraphs.append(html.unescape(text))
+                    paragraphs.append(html.unescape(text) if "&" in text else text)
                 for ph in (cmt.get("photos") or []):
                     url = ph if isinstance(ph, str) else (ph.get("url") if isinstance(ph, dict) else None)
                     if url:
-                        media.append({"kind": "photo", "url": url})
+                        add_media({"kind": "photo", "url": url})
                         mrefs.append(len(media))
                 for vd in (cmt.get("videos") or []):
                     url = vd if isinstance(vd, str) else (vd.get("url") if isinstance(vd, dict) else None)
                     if url:
-                        media.append({"kind": "video", "url": url})
+                        add_media({"kind": "video", "url": url})
                         mrefs.append(len(media))
             body = "\n\n".join(paragraphs).strip()
             if mrefs:
                 body = (body + ("\n\n" if body else "") + " ".join(f"[M#{i}]" for i in mrefs)).strip()
-            items.append({
+            add_item({
                 "section": sname,
                 "sectionNumber": snum,
                 "title": title,
@@ -125,27 +160,60 @@ def extract_items_and_media(data: Dict[str, Any]) -> Tuple[List[Dict[str, Any]],
     return items, media
 
 # =============== Layout helpers ===============
-def wrap_text(text: str, _unused_canvas, max_width: float) -> List[str]:
+# ASCII advance widths of the fixed font in 1/1000 em; summing ints keeps word widths exact
+GLYPH_W = tuple(stringWidth(chr(i), FIXED_FONT, 1000) for i in range(128))
+SPACE_W = stringWidth(" ", FIXED_FONT, FIXED_SIZE)
+
+@lru_cache(maxsize=4096)
+def word_width(w: str) -> float:
+    if not w.isascii():
+        return stringWidth(w, FIXED_FONT, FIXED_SIZE)
+    return sum([GLYPH_W[ord(ch)] for ch in w]) * 0.001 * FIXED_SIZE
+
+@lru_cache(maxsize=1024)
+def _wrap_cached(text: str, max_width: float) -> Tuple[str, ...]:
+    # keyed on the exact width: rounding to whole points would change where lines break
     lines: List[str] = []
-    for para in (text or "").split("\n"):
+    for para in text.split("\n"):
         words = para.split()
         if not words:
             lines.append("")
             continue
-        cur = ""
+        # each word is measured once; the line width is a running sum instead of re-measuring the joined line
+        # (the epsilon absorbs float drift so lines that exactly fit still fit)
+        cur: List[str] = []
+        cur_w = 0.0
         for w in words:
-            test = w if not cur else f"{cur} {w}"
-            if stringWidth(test, FIXED_FONT, FIXED_SIZE) <= max_width:
-                cur = test
+            ww = word_width(w)
+            if cur and cur_w + SPACE_W + ww > max_width + 1e-9:
+                lines.append(" ".join(cur))
+                cur, cur_w = [w], ww
             else:
-                if cur:
-                    lines.append(cur)
-                cur = w
+                cur_w += (SPACE_W if cur else 0.0) + ww
+                cur.append(w)
         if cur:
-            lines.append(cur)
-    return lines
+            lines.append(" ".join(cur))
+    return tuple(lines)
+
+def wrap_text(text: str, max_width: float) -> List[str]:
+    return list(_wrap_cached(text or "", max_width))
+
+def set_font(c: canvas.Canvas, font: str, size: float) -> None:
+    # setFont always emits a Tf operator into the content stream; skip it when the canvas already has that font
+    if c._fontname != font or c._fontsize != size:
+        c.setFont(font, size)
+
+def fill_rects_white(c: canvas.Canvas, rects) -> None:
+    # one path and one fill for every box on the page instead of a rect op per box
+    p = c.beginPath()
+    for rect in rects:
+        rc = rect_coords(rect)
+        p.rect(rc["left"], rc["bottom"], rc["right"]-rc["left"], rc["top"]-rc["bottom"])
+    c.setFillColor(white)
+    c.drawPath(p, fill=1, stroke=0)
+    c.setFillColor(black)
 
-def draw_text_in_rect(c: canvas.Canvas, rect, text: str) -> Tuple[bool, str]:
+def draw_text_in_rect(c: canvas.Canvas, rect, text: str, fill_bg: bool = True) -> Tuple[bool, str]:
     rc = rect_coords(rect)
     left = rc["left"] + LEFT_PAD
     right = rc["right"] - RIGHT_PAD
@@ -153,27 +221,22 @@ def draw_text_in_rect(c: canvas.Canvas, rect, text: str) -> Tuple[bool, str]:
     top = rc["top"] - TOP_PAD
     max_w = max(0, right - left)
     max_h = max(0, top - bottom)
-    c.setFillColor(white)
-    c.rect(rc["left"], rc["bottom"], rc["right"]-rc["left"], rc["top"]-rc["bottom"], fill=1, stroke=0)
-    c.setFillColor(black)
-    lines = wrap_text(text, None, max_w)
+    if fill_bg:
+        fill_rects_white(c, [rect])
+    lines = wrap_text(text, max_w)
     capacity = int(max_h // LINE_HEIGHT)
-    c.setFont(FIXED_FONT, FIXED_SIZE)
+    set_font(c, FIXED_FONT, FIXED_SIZE)
     if capacity <= 0:
         return False, text
+    # one BT/ET text object with T* line steps instead of a positioned drawString per line
+    to = c.beginText(left, top - LINE_HEIGHT)
+    to.setLeading(LINE_HEIGHT)
+    for line in lines[:capacity]:
+        to.textLine(line)
+    c.drawText(to)
     if len(lines) <= capacity:
-        y = top - LINE_HEIGHT
-        for line in lines:
-            c.drawString(left, y, line)
-            y -= LINE_HEIGHT
         return True, ""
-    else:
-        y = top - LINE_HEIGHT
-        for line in lines[:capacity]:
-            c.drawString(left, y, line)
-            y -= LINE_HEIGHT
-        remainder = "\n".join(lines[capacity:])
-        return False, remainder
+    return False, "\n".join(lines[capacity:])
 
 # =============== Header-only overlay (does NOT modify widgets) ===============
 def _rect_tuple(rect):
@@ -183,84 +246,67 @@ def _rect_tuple(rect):
     return (left, bottom, right, top)
 
 def _group_by_rows(rects, y_tol=8.0):
+    # one pass top-down over the rects sorted by vertical center: a rect joins the current row
+    # while it sits within y_tol of that row's mean center, otherwise it starts the next row
     rows = []
-    centers = []
-    for r in rects:
-        _, b, _, t = r
-        yc = 0.5 * (b + t)
-        placed = False
-        for i, (row, cy) in enumerate(zip(rows, centers)):
-            if abs(yc - cy) <= y_tol:
-                row.append(r)
-                centers[i] = (cy * len(row) + yc) / (len(row) + 1e-9)
-                placed = True
-                break
-        if not placed:
+    row_cy = 0.0
+    for yc, r in sorted(((0.5 * (r[1] + r[3]), r) for r in rects), key=lambda t: -t[0]):
+        if rows and abs(yc - row_cy) <= y_tol:
+            row = rows[-1]
+            row.append(r)
+            row_cy += (yc - row_cy) / len(row)
+        else:
             rows.append([r])
-            centers.append(yc)
-    rows = [sorted(row, key=lambda R: R[0]) for row in rows]
-    rows.sort(key=lambda row: -0.5 * (row[0][1] + row[0][3]))
-    return rows
+            row_cy = yc
+    return [sorted(row, key=lambda R: R[0]) for row in rows]
 
 def _draw_shrink_to_fit(c, rect, text, fixed_size=11.0, min_size=8.0, pad=3.0):
     left, bottom, right, top = rect
     text = html.unescape(text or "")
     available = max(1.0, right - left - 2 * pad)
     size = fixed_size
-    while size >= min_size:
-        w = stringWidth(text, FIXED_FONT, size)
-        if w <= available:
-            break
-        size -= 0.5
-    c.setFont(FIXED_FONT, size)
+    w = stringWidth(text, FIXED_FONT, fixed_size)
+    if w > available:
+        # width scales linearly with size, so jump straight to the largest 0.5pt step that fits;
+        # one re-measure settles candidates that sit exactly on the limit
+        steps = math.ceil((fixed_size - fixed_size * available / w) * 2 - 1e-9)
+        size = max(min_size, fixed_size - 0.5 * steps)
+        if size > min_size and stringWidth(text, FIXED_FONT, size) > available:
+            size -= 0.5
+    set_font(c, FIXED_FONT, size)
     x = left + pad
     y = top - 0.65 * (top - bottom)
     c.drawString(x, y, text)
 
-def header_values_list(data: Dict[str, Any]) -> List[str]:
-    addr = getv(data, "address.fullAddress", "")
-    if not addr or addr == "Data not found in test data":
-        parts = [
-            getv(data, "address.street", ""),
-            getv(data, "address.city", ""),
-            getv(data, "address.state", ""),
-            getv(data, "address.zipcode", ""),
-        ]
-        addr = " ".join([p for p in parts if p]) or "Data not found in test data"
-    return [
-        str(getv(data, "clientInfo.name")),
-        ms_to_iso(getv(data, "schedule.date", None)),
-        str(addr),
-        str(getv(data, "inspector.name")),
-        str(getv(data, "inspector.license", "")),
-        "",
-        "",
-    ]
-
-def overlay_fill_header_page1(writer: PdfWriter, data: Dict[str, Any]) -> None:
-    if not writer.pages:
-        return
-    page0 = writer.pages[0]
+def header_field_rects(page0) -> Tuple[Tuple[float, float, float, float], ...]:
+    # text fields in the top quarter of page 1, in reading order
     annots = page0.get("/Annots") or []
+    mb = page0.mediabox
+    top, bottom = float(mb.top), float(mb.bottom)
     rects = []
     for a in annots:
         w = a.get_object()
-        if w.get("/FT") == NameObject("/Tx"):
+        if w.get("/FT") == NM_TX:
             rect = w.get("/Rect")
             if isinstance(rect, ArrayObject) and len(rect) == 4:
                 r = _rect_tuple(rect)
-                top = float(page0.mediabox.top)
-                bottom = float(page0.mediabox.bottom)
                 if r[3] > top - (top - bottom) * 0.25:
                     rects.append(r)
-    if not rects:
+    return tuple(r for row in _group_by_rows(rects, y_tol=8.0) for r in row)
+
+def overlay_fill_header_page1(writer: PdfWriter, header: Dict[str, str], ordered_rects=None) -> None:
+    if not writer.pages:
+        return
+    page0 = writer.pages[0]
+    if ordered_rects is None:
+        ordered_rects = header_field_rects(page0)
+    if not ordered_rects:
         return
-    rows = _group_by_rows(rects, y_tol=8.0)
-    ordered_rects = [r for row in rows for r in row]
-    values = header_values_list(data)
+    # header fields are matched to rects by reading order, which is the key order of extract_header_data
+    values = list(header.values())
     n = min(len(values), len(ordered_rects))
-    pw = float(page0.mediabox.width)
-    ph = float(page0.mediabox.height)
+    mb = page0.mediabox
+    pw, ph = float(mb.width), float(mb.height)
     buf = BytesIO()
     c = canvas.Canvas(buf, pagesize=(pw, ph))
     for i in range(n):
@@ -270,10 +316,11 @@ def overlay_fill_header_page1(writer: PdfWriter, data: Dict[str, Any]) -> None:
     buf.seek(0)
     overlay_reader = PdfReader(buf)
     page0.merge_page(overlay_reader.pages[0])
+    page0.compress_content_streams()
     root = writer._root_object
     acro = root.get("/AcroForm")
     if acro is not None:
-        acro.update({NameObject("/NeedAppearances"): BooleanObject(False)})
+        acro.update({NM_NEED_APPS: BooleanObject(False)})
 
 # =============== Inline-media helpers (optimized) ===============
 MEDIA_TOKEN_RE = re.compile(r"\[M#(\d+)\]")
@@ -282,6 +329,8 @@ def collect_referenced_media_indices(overflow: List[Dict[str, Any]]) -> List[int
     refs = set()
     for it in overflow:
         txt = it.get("text", "") or ""
+        if "[M#" not in txt:
+            continue
         for m in MEDIA_TOKEN_RE.finditer(txt):
             try:
                 refs.add(int(m.group(1)))
@@ -289,54 +338,91 @@ def collect_referenced_media_indices(overflow: List[Dict[str, Any]]) -> List[int
                 pass
     return sorted(refs)
 
-def build_media_map_for_refs(media: List[Dict[str, str]], refs: List[int], max_workers: int = 6) -> Dict[int, Dict[str, Any]]:
-    out: Dict[int, Dict[str, Any]] = {}
-    for i, m in enumerate(media, start=1):
-        out[i] = {"kind": m.get("kind"), "url": m.get("url", ""), "img": None}
-    if not refs:
-        return out
-
+@lru_cache(maxsize=1)
+def http_session():
+    # one keep-alive pool for every image fetch in the process; requests (~85 ms to import) is only
+    # loaded once a photo actually has to be downloaded
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     sess = requests.Session()
-    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry, pool_connections=max_workers, pool_maxsize=max_workers)
+    adapter = HTTPAdapter(
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]),
+        pool_connections=IMG_WORKERS,
+        pool_maxsize=IMG_WORKERS,
+    )
     sess.mount("http://", adapter)
     sess.mount("https://", adapter)
+    return sess
 
-    def fetch_one(idx: int):
-        meta = out.get(idx)
-        if not meta or meta.get("kind") != "photo":
-            return idx, None
-        url = meta.get("url")
-        if not url:
-            return idx, None
-        try:
-            r = sess.get(url, timeout=6, stream=True)
+def fetch_image(url: str) -> Optional[Tuple[ImageReader, Tuple[int, int]]]:
+    try:
+        with http_session().get(url, timeout=6, stream=True) as r:
             if r.status_code != 200:
-                return idx, None
+                return None
             cl = r.headers.get("content-length")
-            if cl and int(cl) > 5_000_000 and SKIP_LARGE_IMAGES:
-                return idx, None
-            img = Image.open(BytesIO(r.content))
-            if img.mode in ("RGBA", "LA", "P"):
-                rgb = Image.new("RGB", img.size, (255, 255, 255))
-                if img.mode == "P":
-                    img = img.convert("RGBA")
-                rgb.paste(img, mask=img.split()[-1] if img.mode in ("RGBA", "LA") else None)
-                img = rgb
-            img.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
-            buf = BytesIO()
-            img.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True)
-            buf.seek(0)
-            return idx, ImageReader(Image.open(buf))
-        except Exception:
-            return idx, None
+            if cl and int(cl) > MAX_IMAGE_BYTES and SKIP_LARGE_IMAGES:
+                return None
+            # read in chunks so a missing or lying Content-Length still cannot pull more than the cap
+            buf = bytearray()
+            for chunk in r.iter_content(65536):
+                buf.extend(chunk)
+                if len(buf) > MAX_IMAGE_BYTES and SKIP_LARGE_IMAGES:
+                    return None
+        data = bytes(buf)
+        img = Image.open(BytesIO(data))
+        # small enough RGB/gray JPEGs go in as-is: ReportLab embeds the DCT stream without decoding it
+        if img.format == "JPEG" and img.mode in ("RGB", "L") and img.width <= MAX_IMAGE_SIZE[0] and img.height <= MAX_IMAGE_SIZE[1]:
+            return ImageReader(BytesIO(data)), img.size
+        if img.mode in ("RGBA", "LA", "P"):
+            rgb = Image.new("RGB", img.size, (255, 255, 255))
+            if img.mode == "P":
+                img = img.convert("RGBA")
+            rgb.paste(img, mask=img.split()[-1] if img.mode in ("RGBA", "LA") else None)
+            img = rgb
+        img.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
+        # encode once and hand ReportLab the JPEG bytes: it embeds them as DCT without decoding them again
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=JPEG_OPTIMIZE)
+        buf.seek(0)
+        return ImageReader(buf), img.size
+    except Exception:
+        return None
+
+def build_media_map_for_refs(media: List[Dict[str, str]], refs: List[int], max_workers: int = IMG_WORKERS) -> Dict[int, Dict[str, Any]]:
+    # only the tokens the appendix draws get an entry; anything else is never looked up
+    out: Dict[int, Dict[str, Any]] = {}
+    for i in refs:
+        if 1 <= i <= len(media):
+            m = media[i - 1]
+            out[i] = {"kind": m.get("kind"), "url": m.get("url", ""), "img": None, "size": None}
+    # only photos are downloaded, and each distinct URL once: every token pointing at it shares
+    # one ImageReader, so the image is also embedded as a single XObject
+    by_url: Dict[str, List[int]] = {}
+    for idx in refs:
+        meta = out.get(idx)
+        if meta and meta["kind"] == "photo" and meta["url"]:
+            by_url.setdefault(meta["url"], []).append(idx)
+    for url in list(by_url):
+        hit = _IMG_CACHE.get(url)
+        if hit is not None:
+            _IMG_CACHE.move_to_end(url)
+            for idx in by_url.pop(url):
+                out[idx]["img"], out[idx]["size"] = hit
+    if not by_url:
+        return out
+    max_workers = max(1, min(max_workers, len(by_url)))
+    http_session()  # build the shared session before the workers race to create it
 
     with ThreadPoolExecutor(max_workers=max_workers) as pool:
-        futures = [pool.submit(fetch_one, idx) for idx in refs]
-        for fut in as_completed(futures):
-            idx, img_reader = fut.result()
-            if idx in out and out[idx]["kind"] == "photo":
-                out[idx]["img"] = img_reader
+        for url, fetched in zip(by_url, pool.map(fetch_image, by_url)):
+            if fetched is None:
+                continue
+            for idx in by_url[url]:
+                out[idx]["img"], out[idx]["size"] = fetched
+            _IMG_CACHE[url] = fetched
+            if len(_IMG_CACHE) > IMG_CACHE_SIZE:
+                _IMG_CACHE.popitem(last=False)
     return out
 
 def draw_inline_richblock(
@@ -352,10 +438,10 @@ def draw_inline_richblock(
     def draw_wrapped(chunk: str, y0: float) -> float:
         if not chunk:
             return y0
-        c.setFont(FIXED_FONT, FIXED_SIZE)
-        for ln in wrap_text(chunk, None, width):
+        set_font(c, FIXED_FONT, FIXED_SIZE)
+        for ln in wrap_text(chunk, width):
             if y0 < 60:
-                c.showPage(); c.setFont(FIXED_FONT, FIXED_SIZE)
+                c.showPage(); set_font(c, FIXED_FONT, FIXED_SIZE)
                 y0 = page_h - 60
             c.drawString(x, y0, ln)
             y0 -= LINE_HEIGHT
@@ -369,40 +455,37 @@ def draw_inline_richblock(
         idx = int(m.group(1))
         meta = media_map.get(idx)
         if y < 70:
-            c.showPage(); c.setFont(FIXED_FONT, FIXED_SIZE)
+            c.showPage(); set_font(c, FIXED_FONT, FIXED_SIZE)
             y = page_h - 60
 
         if not meta:
-            c.setFont("Helvetica-Bold", 10)
+            set_font(c, "Helvetica-Bold", 10)
             c.drawString(x, y, f"M#{idx}: (missing)")
             y -= LINE_HEIGHT
-            c.setFont(FIXED_FONT, FIXED_SIZE)
+            set_font(c, FIXED_FONT, FIXED_SIZE)
         else:
             kind = meta.get("kind")
             if kind == "photo" and meta.get("img"):
                 img: ImageReader = meta["img"]
-                try:
-                    iw, ih = getattr(img, "_image", getattr(img, "image", None)).size
-                except Exception:
-                    iw, ih = (800, 600)
+                iw, ih = meta["size"]
                 scale = min(width / iw, INLINE_IMG_MAX_H / ih)
                 rw, rh = iw * scale, ih * scale
                 if y - rh - 16 < 60:
-                    c.showPage(); c.setFont(FIXED_FONT, FIXED_SIZE)
+                    c.showPage(); set_font(c, FIXED_FONT, FIXED_SIZE)
                     y = page_h - 60
-                c.setFont("Helvetica-Bold", 10)
+                set_font(c, "Helvetica-Bold", 10)
                 c.drawString(x, y, f"M#{idx}: photo")
                 y -= 12
-                c.drawImage(img, x, y - rh, width=rw, height=rh, preserveAspectRatio=True, mask='auto')
+                c.drawImage(img, x, y - rh, width=rw, height=rh, mask='auto')
                 y = y - rh - 8
-                c.setFont(FIXED_FONT, FIXED_SIZE)
+                set_font(c, FIXED_FONT, FIXED_SIZE)
             elif kind == "video":
                 label = f"M#{idx}: video"
                 url = meta.get("url") or ""
                 if y < 70:
-                    c.showPage(); c.setFont(FIXED_FONT, FIXED_SIZE)
+                    c.showPage(); set_font(c, FIXED_FONT, FIXED_SIZE)
                     y = page_h - 60
-                c.setFont("Helvetica-Bold", 10)
+                set_font(c, "Helvetica-Bold", 10)
                 c.setFillColor(HexColor("#0645AD"))
                 c.drawString(x, y, label)
                 tw = stringWidth(label, "Helvetica-Bold", 10)
@@ -410,12 +493,12 @@ def draw_inline_richblock(
                     c.linkURL(url, (x, y - 2, x + tw, y + 10), relative=0)
                 c.setFillColor(black)
                 y -= LINE_HEIGHT
-                c.setFont(FIXED_FONT, FIXED_SIZE)
+                set_font(c, FIXED_FONT, FIXED_SIZE)
             else:
-                c.setFont("Helvetica-Bold", 10)
+                set_font(c, "Helvetica-Bold", 10)
                 c.drawString(x, y, f"M#{idx}: photo (unavailable)")
                 y -= LINE_HEIGHT
-                c.setFont(FIXED_FONT, FIXED_SIZE)
+                set_font(c, FIXED_FONT, FIXED_SIZE)
 
         pos = m.end()
 
@@ -424,50 +507,75 @@ def draw_inline_richblock(
     return y
 
 # =============== Main PDF fill ===============
+CHECKBOX_RE = re.compile(r"CheckBox1\[(\d+)\]$")
+
+def _checkbox_index(name: str) -> Optional[int]:
+    # template names end in "CheckBox1[<n>]"; slice that out and only fall back to the regex for odd names
+    if name.endswith("]"):
+        digits = name[name.rfind("CheckBox1[") + 10:-1]
+        if digits.isdecimal():
+            return int(digits)
+    m = CHECKBOX_RE.search(name)
+    return int(m.group(1)) if m else None
+
+_TEMPLATE_LOCK = threading.Lock()
+
+@lru_cache(maxsize=4)
+def _load_template(path: str, mtime_ns: int) -> PdfReader:
+    # keyed on mtime so an edited template is re-read; repeat runs in one process skip the parse
+    return PdfReader(BytesIO(Path(path).read_bytes()))
+
+@lru_cache(maxsize=4)
+def _template_header_rects(reader: PdfReader):
+    # the header layout belongs to the template, so a cached reader only has it worked out once
+    return header_field_rects(reader.pages[0]) if reader.pages else ()
+
 def fill_trec_form(template_path: Path, data: Dict[str, Any], output_path: Path):
     print(f"📄 Template: {template_path}")
-    reader = PdfReader(str(template_path))
     writer = PdfWriter()
-    writer.clone_document_from_reader(reader)
+    with _TEMPLATE_LOCK:
+        reader = _load_template(str(template_path), Path(template_path).stat().st_mtime_ns)
+        writer.clone_document_from_reader(reader)
+        header_rects = _template_header_rects(reader)
 
     print("📊 Parsing JSON ...")
     header = extract_header_data(data)
     items, media = extract_items_and_media(data)
     print(f"   Items: {len(items)}, media: {len(media)}")
 
-    overlay_fill_header_page1(writer, data)
+    overlay_fill_header_page1(writer, header, header_rects)
 
-    checkbox_pat = re.compile(r"CheckBox1\[(\d+)\]$")
     checkboxes = []
     comment_fields = []
+    tx_slots: List[List[int]] = []  # per page, the /Annots positions of every /Tx widget
 
     for pidx, page in enumerate(writer.pages):
         annots = page.get("/Annots") or []
-        for a in annots:
+        tx_at = []
+        tx_slots.append(tx_at)
+        for j, a in enumerate(annots):
             w = a.get_object()
+            ftype = w.get("/FT")
+            if ftype == NM_TX:
+                tx_at.append(j)
             name = w.get("/T")
             if not name:
                 continue
             name_str = str(name)
-            ftype = w.get("/FT")
             rect = w.get("/Rect")
             if not isinstance(rect, ArrayObject):
                 continue
-            if ftype == NameObject("/Tx"):
-                if pidx == 0:
-                    rc = rect_coords(rect)
-                    top = float(page.mediabox.top); bottom = float(page.mediabox.bottom)
-                    if rc["top"] > top - (top - bottom) * 0.25:
-                        continue
-                rc = rect_coords(rect)
-                wpx = rc["right"] - rc["left"]
-                hpx = rc["top"] - rc["bottom"]
-                if wpx >= 300 and hpx >= 50 and pidx in (2, 3, 4, 5):
-                    comment_fields.append((pidx, rect, a))
-            elif ftype == NameObject("/Btn") and "CheckBox1[" in name_str:
-                m = checkbox_pat.search(name_str)
-                if m:
-                    checkboxes.append((pidx, int(m.group(1)), w))
+            if ftype == NM_TX:
+                # comment boxes only live on pages 3-6, so page-1 header fields never get this far
+                if pidx not in (2, 3, 4, 5):
+                    continue
+                x0, y0, x1, y1 = [float(v) for v in rect]
+                if abs(x1 - x0) >= 300 and abs(y1 - y0) >= 50:
+                    comment_fields.append((pidx, (x0, y0, x1, y1), a, max(y0, y1)))
+            elif ftype == NM_BTN and "CheckBox1[" in name_str:
+                num = _checkbox_index(name_str)
+                if num is not None:
+                    checkboxes.append((pidx, num, w))
 
     print(f"   Comment boxes: {len(comment_fields)} | checkboxes: {len(checkboxes)}")
 
@@ -477,143 +585,153 @@ def fill_trec_form(template_path: Path, data: Dict[str, Any], output_path: Path)
     checkboxes.sort(key=lambda t: (t[0], t[1]))
     order = [I, NI, NP, D]
     idx = 0
+    n_checkboxes = len(checkboxes)
     for it in items:
-        if idx + 4 > len(checkboxes):
+        if idx + 4 > n_checkboxes:
             break
-        grp = checkboxes[idx:idx+4]
-        for j, code in enumerate(order):
-            w = grp[j][2]
-            ap = w.get("/AP") or {}
-            normal = ap.get("/N") or {}
+        status = it.get("status") or ""
+        for code, (_, _, w) in zip(order, checkboxes[idx:idx+4]):
             on_name = None
-            for k in normal.keys():
-                if k != NameObject("/Off"):
-                    on_name = k
-                    break
-            if (it.get("status") or "") == code and on_name:
-                w.update({NameObject("/V"): on_name, NameObject("/AS"): on_name})
+            if status == code:
+                # only the box being checked needs its "on" appearance name
+                ap = w.get("/AP")
+                normal = (ap.get("/N") or {}) if ap else {}
+                on_name = next((k for k in normal if k != NM_OFF), None)
+            if on_name:
+                w.update({NM_V: on_name, NM_AS: on_name})
             else:
-                w.update({NameObject("/V"): NameObject("/Off"), NameObject("/AS"): NameObject("/Off")})
+                w.update(OFF_STATE)
         idx += 4
 
-    comment_fields.sort(key=lambda t: (t[0], -rect_coords(t[1])["top"]))
+    comment_fields.sort(key=lambda t: (t[0], -t[3]))
     max_bind = min(len(items), len(comment_fields))
     for i in range(max_bind):
         it = items[i]
-        pidx, rect, aref = comment_fields[i]
-        overlays[pidx].append({"rect": tuple(float(x) for x in rect), "text": it.get("text", ""), "kind": "comment", "item": it})
-        page = writer.pages[pidx]
-        ann = page.get("/Annots")
-        if ann:
-            page[NameObject("/Annots")] = ArrayObject([x for x in ann if x != aref])
-
-    for page in writer.pages:
-        ann = page.get("/Annots")
-        if not ann:
-            continue
-        keep = ArrayObject()
-        for a in ann:
-            w = a.get_object()
-            if w.get("/FT") != NameObject("/Tx"):
-                keep.append(a)
-        if len(keep):
-            page[NameObject("/Annots")] = keep
+        pidx, rect, _, _ = comment_fields[i]
+        overlays[pidx].append(Overlay(rect, it.get("text", ""), it))
+
+    # Bound comment fields are /Tx widgets too, so one filter per page drops them along with every other
+    # text field; the positions come from the discovery pass, so no widget is resolved a second time
+    for page, tx_at in zip(writer.pages, tx_slots):
+        if not tx_at:
+            continue  # no text widgets here; keep the original array
+        drop = set(tx_at)
+        keep = [a for j, a in enumerate(page[NM_ANNOTS]) if j not in drop]
+        if keep:
+            page[NM_ANNOTS] = ArrayObject(keep)
         else:
             try:
-                del page[NameObject("/Annots")]
+                del page[NM_ANNOTS]
             except KeyError:
                 pass
 
-    for pidx in range(len(writer.pages)):
-        if not overlays[pidx]:
-            continue
-        pw = float(writer.pages[pidx].mediabox.width)
-        ph = float(writer.pages[pidx].mediabox.height)
+    # every overlay page goes into one canvas, so the overlay PDF is written and parsed once
+    # a page whose bound comments are all blank would only get white boxes over already-removed
+    # fields, so it is left out of the overlay instead of paying for a merge_page
+    overlay_pages = [pidx for pidx in range(len(writer.pages)) if any(ov.text.strip() for ov in overlays[pidx])]
+    if overlay_pages:
         buf = BytesIO()
-        c = canvas.Canvas(buf, pagesize=(pw, ph))
-        for ov in overlays[pidx]:
-            ok, rest = draw_text_in_rect(c, ov["rect"], ov["text"])
-            if (not ok) and rest.strip():
-                it = ov.get("item", {})
-                overflow.append({
-                    "section": it.get("section", ""),
-                    "sectionNumber": it.get("sectionNumber", ""),
-                    "title": it.get("title", ""),
-                    "text": rest
-                })
-        c.showPage(); c.save(); buf.seek(0)
-        overlay_reader = PdfReader(buf)
-        writer.pages[pidx].merge_page(overlay_reader.pages[0])
+        c = canvas.Canvas(buf)
+        for pidx in overlay_pages:
+            mb = writer.pages[pidx].mediabox
+            c.setPageSize((float(mb.width), float(mb.height)))
+            fill_rects_white(c, [ov.rect for ov in overlays[pidx]])
+            for ov in overlays[pidx]:
+                ok, rest = draw_text_in_rect(c, ov.rect, ov.text, fill_bg=False)
+                if (not ok) and rest.strip():
+                    it = ov.item
+                    overflow.append({
+                        "section": it.get("section", ""),
+                        "sectionNumber": it.get("sectionNumber", ""),
+                        "title": it.get("title", ""),
+                        "text": rest
+                    })
+            c.showPage()
+        c.save(); buf.seek(0)
+        for pidx, overlay_page in zip(overlay_pages, PdfReader(buf).pages):
+            page = writer.pages[pidx]
+            page.merge_page(overlay_page)
+            # merge_page leaves the combined content stream uncompressed; untouched template pages keep theirs
+            page.compress_content_streams()
 
     for it in items[max_bind:]:
         overflow.append(it)
 
-    # Build media map only for referenced tokens, with concurrency
-    refs = collect_referenced_media_indices(overflow)
-    media_map = build_media_map_for_refs(media, refs, max_workers=int(os.environ.get("IMG_WORKERS", "6")))
-
-    # Appendix with inline media
-    app_buf = BytesIO()
-    pw0 = float(writer.pages[0].mediabox.width)
-    ph0 = float(writer.pages[0].mediabox.height)
-    c = canvas.Canvas(app_buf, pagesize=(pw0, ph0))
-    W, H = pw0, ph0
-    x, y = 60, H - 60
-    text_width = W - 120
-
+    # No overflow means no appendix: skip the media fetch and the trailing page entirely
     if overflow:
-        c.setFont("Helvetica-Bold", 14)
+        # Build media map only for referenced tokens, with concurrency
+        refs = collect_referenced_media_indices(overflow)
+        media_map = build_media_map_for_refs(media, refs)
+
+        # Appendix with inline media
+        app_buf = BytesIO()
+        mb0 = writer.pages[0].mediabox
+        pw0, ph0 = float(mb0.width), float(mb0.height)
+        c = canvas.Canvas(app_buf, pagesize=(pw0, ph0))
+        W, H = pw0, ph0
+        x, y = 60, H - 60
+        text_width = W - 120
+        set_font(c, "Helvetica-Bold", 14)
         c.drawString(x, y, "Additional Information Provided by Inspector")
         y -= 24
-        c.setFont(FIXED_FONT, FIXED_SIZE)
+        set_font(c, FIXED_FONT, FIXED_SIZE)
 
         def rich_block(txt: str, width: float, y0: float) -> float:
             paras = (txt or "").split("\n")
             for para in paras:
                 if para.strip() == "":
                     if y0 < 60:
-                        c.showPage(); c.setFont(FIXED_FONT, FIXED_SIZE)
+                        c.showPage(); set_font(c, FIXED_FONT, FIXED_SIZE)
                         y0 = H - 60
                     y0 -= LINE_HEIGHT
                     continue
                 y0 = draw_inline_richblock(c, para, width, x, y0, W, H, media_map)
             return y0
 
+        head_key, head = None, ""
         for it in overflow:
-            head = " — ".join([s for s in [f"{it.get('sectionNumber','')}. {it.get('section','')}".strip(". "), it.get('title','')] if s])
+            key = (it.get('sectionNumber', ''), it.get('section', ''), it.get('title', ''))
+            if key != head_key:
+                head_key = key
+                head = " — ".join([s for s in [f"{key[0]}. {key[1]}".strip(". "), key[2]] if s])
             if head:
-                c.setFont("Helvetica-Bold", 11)
+                set_font(c, "Helvetica-Bold", 11)
                 y = draw_inline_richblock(c, head, text_width, x, y, W, H, media_map)
-                c.setFont(FIXED_FONT, FIXED_SIZE)
+                set_font(c, FIXED_FONT, FIXED_SIZE)
             if it.get("text"):
                 y = rich_block(it["text"], text_width, y)
             y -= LINE_HEIGHT/2
 
-    c.showPage(); c.save(); app_buf.seek(0)
-    app_reader = PdfReader(app_buf)
-    for pg in app_reader.pages:
-        writer.add_page(pg)
+        c.showPage(); c.save(); app_buf.seek(0)
+        writer.append(app_buf, import_outline=False)
 
     root = writer._root_object
     acro = root.get("/AcroForm")
     if acro is not None:
-        acro.update({NameObject("/NeedAppearances"): BooleanObject(False)})
+        acro.update({NM_NEED_APPS: BooleanObject(False)})
 
     print(f"💾 Writing: {output_path}")
-    with open(output_path, "wb") as f:
+    with open(output_path, "wb", buffering=WRITE_BUFFER) as f:
         writer.write(f)
 
 # =============== CLI ===============
+@lru_cache(maxsize=1)
+def _arg_parser() -> argparse.ArgumentParser:
+    # positional paths win over the env vars, which win over the files next to this script
+    here = Path(__file__).parent
+    p = argparse.ArgumentParser(description="Fill the TREC inspection template from an inspection JSON file.")
+    p.add_argument("json_path", nargs="?", type=Path, default=Path(os.environ.get("JSON_PATH", here / "inspection.json")))
+    p.add_argument("template_path", nargs="?", type=Path, default=Path(os.environ.get("TREC_TEMPLATE", here / "TREC_Template_Blank.pdf")))
+    p.add_argument("output_path", nargs="?", type=Path, default=Path(os.environ.get("OUT_PATH", here / "output_pdf.pdf")))  # final name as requested
+    return p
+
 def main():
     t0 = time.time()
-    here = Path(__file__).parent
-    json_path = Path(os.environ.get("JSON_PATH", here / "inspection.json"))
-    tpl_path = Path(os.environ.get("TREC_TEMPLATE", here / "TREC_Template_Blank.pdf"))
-    out_path = Path(os.environ.get("OUT_PATH", here / "output_pdf.pdf"))  # final name as requested
+    args = _arg_parser().parse_args()
+    json_path, tpl_path, out_path = args.json_path, args.template_path, args.output_path
 
     print("\n=== TREC Inspection Report PDF Generator (header-first, overlap-safe, inline media, optimized) ===\n")
-    with open(json_path, "r", encoding="utf-8") as f:
-        raw = json.load(f)
+    raw = _json_loads(json_path.read_bytes())
     data = raw.get("inspection", raw)
 
     fill_trec_form(tpl_path, data, out_path)